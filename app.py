@@ -1,11 +1,21 @@
 import os
 import re
+import time
 import streamlit as st
-from datetime import date, datetime
+from datetime import date
 import yt_dlp
 import pandas as pd
 import random
 import json
+import heapq
+import hashlib
+import threading
+import tempfile
+from functools import lru_cache
+from urllib.parse import unquote
+import tiktoken
+from concurrent.futures import Future, ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from googleapiclient.discovery import build
 from openai import OpenAI
 
@@ -13,12 +23,28 @@ from openai import OpenAI
 OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY")
 YT_API_KEY = st.secrets.get("YOUTUBE_API_KEY")
 
+@st.cache_resource
+def get_openai_client(api_key):
+    """Клієнт OpenAI, спільний для всіх перезапусків скрипта."""
+    return OpenAI(api_key=api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_youtube_service(api_key):
+    """
+    Сервіс YouTube Data API, спільний для всіх перезапусків скрипта.
+    static_discovery=True бере discovery-документ, що постачається з google-api-python-client,
+    замість HTTP-запиту до нього під час build().
+    """
+    return build("youtube", "v3", developerKey=api_key, static_discovery=True, cache_discovery=False)
+
+
 # Ініціалізація клієнта OpenAI
 if not OPENAI_API_KEY:
     st.error("Ключ OpenAI API (OPENAI_API_KEY) не знайдено у Streamlit Secrets. Будь ласка, додайте його.")
     client = None
 else:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client(OPENAI_API_KEY)
 
 # Перевірка ключа YouTube Data API
 if not YT_API_KEY:
@@ -37,227 +63,580 @@ st.markdown(
 
 # --- Функції ---
 
+# Модель OpenAI за замовчуванням для всіх GPT-аналізів
+DEFAULT_MODEL = "gpt-4o-mini"
+
+# Кількість паралельних запитів yt_dlp при зборі метаданих відео
+YDL_MAX_WORKERS = 10
+
+# Скомпільовані регулярні вирази для розбору URL
+_CHANNEL_AT_RE = re.compile(r"(?:https?://)?(?:www\.)?youtube\.com/@([^/?]+)")
+_CHANNEL_UC_RE = re.compile(r"(?:https?://)?(?:www\.)?youtube\.com/channel/([^/?]+)")
+_VIDEO_ID_RE = re.compile(r"(?:v=|youtu\.be/|shorts/|embed/|watch\?v=|\&v=)([\w-]{11})")
+_VIDEO_ID_ONLY_RE = re.compile(r"^[\w-]{11}$")
+_ISO_DURATION_RE = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?")
+
+# Мережеві налаштування yt_dlp: недоступний канал чи відео має падати за ~10 с,
+# а не після стандартної багатохвилинної серії повторів
+YDL_NETWORK_OPTS = {'socket_timeout': 10, 'retries': 1, 'extractor_retries': 1}
+
+# Опції yt_dlp для отримання даних одного відео в обробнику аналізу
+VIDEO_DETAILS_YDL_OPTS = {'quiet': True, 'no_warnings': True, 'skip_download': True, 'ignoreerrors': True,
+                          'extract_flat': False, **YDL_NETWORK_OPTS}
+
+# Поля info-словника yt_dlp, що показуються в обробнику аналізу
+VIDEO_DETAILS_FIELDS = ('title', 'thumbnail', 'duration', 'view_count', 'like_count', 'comment_count', 'upload_date')
+
+# Дисковий кеш даних відео (JSON-файл на ID відео), що переживає перезапуск застосунку,
+# і час, після якого запис вважається застарілим (лічильники переглядів і лайків змінюються)
+VIDEO_DETAILS_CACHE_DIR = os.path.expanduser("~/.cache/contentai/videos")
+VIDEO_DETAILS_CACHE_TTL = 24 * 3600
+
+# Поля flat-запису yt_dlp, без яких відео каналу довантажується окремим запитом
+FLAT_ENTRY_REQUIRED_FIELDS = ('view_count', 'like_count', 'comment_count', 'duration')
+
+# Розмір спільного пулу потоків для паралельних мережевих викликів у обробнику аналізу
+IO_MAX_WORKERS = 8
+
+# Максимальна кількість коментарів, що завантажуються для одного відео (відповідає частці "100%")
+MAX_COMMENTS_LIMIT = 1000
+
+# Скільки коментарів у порядку "relevance" завантажується для топу найпопулярніших
+TOP_COMMENTS_POOL_SIZE = 100
+
+# Максимальна довжина одного коментаря у промптах GPT (символів)
+LLM_COMMENT_MAX_CHARS = 200
+
+# Мінімальна кількість коментарів у вибірці, з якою є сенс звертатися до GPT:
+# меншу вибірку UI показує як є, без запиту
+LLM_MIN_COMMENTS = 5
+
+# Бюджети токенів для блоку коментарів у промптах GPT: вибірка обрізається, щойно бюджет вичерпано.
+# UI передає звіту й підсумку спільну вибірку з бюджетом звіту; бюджет підсумку діє лише для
+# зовнішніх викликів gpt_comment_summary/gpt_comment_summary_stream без готової вибірки
+LLM_REPORT_TOKEN_BUDGET = 6000
+LLM_SUMMARY_TOKEN_BUDGET = 3000
+
+# Часткові відповіді commentThreads.list: лише поля, які використовує UI.
+# Відповіді на коментарі завантажуються окремо і лише для топ-коментарів
+COMMENT_THREAD_FIELDS = "nextPageToken,items(id,snippet/topLevelComment/snippet(textDisplay,likeCount))"
+COMMENT_REPLIES_FIELDS = "items(id,replies/comments(snippet(textDisplay,likeCount)))"
+
+# Часткова відповідь videos.list: лише поля, з яких складаються метадані відео каналу
+VIDEO_LIST_FIELDS = ("items(id,snippet(title,publishedAt,thumbnails/high/url),"
+                     "statistics(viewCount,likeCount,commentCount),contentDetails/duration)")
+
+class FetchError(Exception):
+    """
+    Невдалий мережевий запит у кешованій функції. st.cache_data не кешує винятки, тож помилка
+    не повертатиметься з кешу при повторній спробі; result — частковий результат для UI.
+    Некешовані обгортки перетворюють її на кортеж (результат, повідомлення про помилку).
+    """
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+@lru_cache(maxsize=256)
 def extract_channel_id(url_input):
     """Витягує ID каналу або ім'я користувача з URL."""
-    match_user = re.search(r"(?:https?://)?(?:www\.)?youtube\.com/@([^/?]+)", url_input)
+    match_user = _CHANNEL_AT_RE.search(url_input)
     if match_user:
         return match_user.group(1)
-    match_channel = re.search(r"(?:https?://)?(?:www\.)?youtube\.com/channel/([^/?]+)", url_input)
+    match_channel = _CHANNEL_UC_RE.search(url_input)
     if match_channel:
         return match_channel.group(1)
     return None
 
 
-def fetch_video_metadata(channel_id_or_user, start_date, end_date, limit=10, show_all=False):
+@lru_cache(maxsize=256)
+def extract_video_id(video_url):
+    """Витягує 11-символьний ID відео з URL або повертає сам рядок, якщо це вже ID; інакше None."""
+    match_video = _VIDEO_ID_RE.search(video_url)
+    if match_video:
+        return match_video.group(1)
+    return video_url if _VIDEO_ID_ONLY_RE.match(video_url) else None
+
+
+def _parse_yt_date(date_str):
+    """Розбирає дату yt_dlp у форматі YYYYMMDD прямим зрізом рядка (швидше за strptime)."""
+    if not date_str or len(date_str) != 8 or not date_str.isdigit(): return None
+    try:
+        return date(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]))
+    except ValueError:
+        return None
+
+
+def _parse_iso_duration(duration_str):
+    """Перетворює тривалість ISO 8601 з YouTube Data API (напр. PT1H2M3S) на секунди."""
+    match = _ISO_DURATION_RE.fullmatch(duration_str or "")
+    if not match: return 0
+    days, hours, minutes, seconds = (int(g) if g else 0 for g in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def _uploads_playlist_id(channel_id):
     """
-    Збирає метадані відео з каналу або від користувача за допомогою yt_dlp.
-    Фільтрує за датою.
-    Примітка: ця функція наразі не використовується в основному потоці UI.
+    ID плейлиста завантажень каналу (ID UC... або @-ім'я) через channels.list (за id або forHandle).
+    @-ім'я з URL браузера може бути percent-encoded (кирилиця), тому воно декодується перед запитом.
+    Повертає None, якщо канал не знайдено або запит не вдався (квота, мережа) — тоді працює yt_dlp.
     """
-    if not channel_id_or_user:
-        st.error("Не надано ID каналу або ім'я користувача.")
-        return []
+    channel_lookup = {"id": channel_id} if channel_id.startswith("UC") else {"forHandle": unquote(channel_id)}
+    try:
+        channel_response = get_youtube_service(YT_API_KEY).channels().list(
+            part="contentDetails", fields="items/contentDetails/relatedPlaylists/uploads", **channel_lookup
+        ).execute()
+        channel_items = channel_response.get("items", [])
+        return channel_items[0]["contentDetails"]["relatedPlaylists"]["uploads"] if channel_items else None
+    except Exception:
+        return None
+
+def _list_channel_videos_api(channel_id, uploads_playlist_id, start_date, end_date, limit=10, show_all=False):
+    """
+    Збирає метадані відео каналу через YouTube Data API замість yt_dlp: плейлист завантажень
+    (див. _uploads_playlist_id) -> playlistItems.list (по 50) -> videos.list (по 50 ID за запит).
+    Плейлист завантажень упорядкований від нових до старих, тому пагінація зупиняється,
+    щойно трапилось відео, старіше за start_date. Повертає (відео, помилка або None).
+    """
+    try:
+        youtube_service = get_youtube_service(YT_API_KEY)
+        video_ids = []
+        next_page_token = None
+        reached_start = False
+        while not reached_start:
+            playlist_response = youtube_service.playlistItems().list(
+                part="contentDetails", playlistId=uploads_playlist_id, maxResults=50,
+                pageToken=next_page_token,
+                fields="nextPageToken,items/contentDetails(videoId,videoPublishedAt)"
+            ).execute()
+            for item in playlist_response.get("items", []):
+                details = item.get("contentDetails", {})
+                published_at = details.get("videoPublishedAt")
+                publish_date = date.fromisoformat(published_at[:10]) if published_at else None
+                if not show_all:
+                    if publish_date and publish_date < start_date:
+                        reached_start = True
+                        break
+                    if not publish_date or publish_date > end_date: continue
+                video_ids.append(details["videoId"])
+                if not show_all and len(video_ids) >= limit:
+                    reached_start = True
+                    break
+            next_page_token = playlist_response.get("nextPageToken")
+            if not next_page_token: break
+
+        videos = []
+        for batch_start in range(0, len(video_ids), 50):
+            videos_response = youtube_service.videos().list(
+                part="snippet,statistics,contentDetails", id=",".join(video_ids[batch_start:batch_start + 50]),
+                fields=VIDEO_LIST_FIELDS
+            ).execute()
+            for item in videos_response.get("items", []):
+                snippet, statistics = item.get("snippet", {}), item.get("statistics", {})
+                published_at = snippet.get("publishedAt")
+                videos.append({
+                    'title': snippet.get('title', 'Без назви'), 'views': int(statistics.get('viewCount', 0)),
+                    'likes': int(statistics['likeCount']) if 'likeCount' in statistics else None,
+                    'comments_count': int(statistics['commentCount']) if 'commentCount' in statistics else None,
+                    'duration': _parse_iso_duration(item.get("contentDetails", {}).get("duration")),
+                    'publish_date': date.fromisoformat(published_at[:10]) if published_at else None,
+                    'thumbnail_url': snippet.get('thumbnails', {}).get('high', {}).get('url'),
+                    'url': f"https://www.youtube.com/watch?v={item['id']}"
+                })
+        return videos, None
+    except Exception as e:
+        return [], f"Помилка YouTube API при отриманні відео каналу {channel_id}: {e}"
 
-    if channel_id_or_user.startswith("UC"):
-        url = f"https://www.youtube.com/channel/{channel_id_or_user}/videos"
-        st.info(f"Спроба збору відео для ID каналу: {channel_id_or_user}.")
-    else:
-        url = f"https://www.youtube.com/@{channel_id_or_user}/videos"
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _fetch_video_metadata_raw(channel_id_or_user, start_date, end_date, limit=10, show_all=False):
+    """
+    Збирає метадані відео з каналу або від користувача.
+    За наявності YT_API_KEY використовує пакетні запити YouTube Data API, інакше (або якщо
+    API не знайшов канал чи відмовив) — yt_dlp.
+    Фільтрує за датою. Результат кешується, тому функція не звертається до st.*:
+    повертає список відео, а за будь-якої помилки піднімає FetchError (з частковим списком у result).
+    """
+    uploads_playlist_id = _uploads_playlist_id(channel_id_or_user) if YT_API_KEY else None
+    if uploads_playlist_id:
+        videos, error = _list_channel_videos_api(
+            channel_id_or_user, uploads_playlist_id, start_date, end_date, limit, show_all)
+        if error: raise FetchError(error, videos)
+        return videos
+
+    url = (f"https://www.youtube.com/channel/{channel_id_or_user}/videos" if channel_id_or_user.startswith("UC")
+           else f"https://www.youtube.com/@{channel_id_or_user}/videos")
 
     opts_flat = {
-        'ignoreerrors': True, 'skip_download': True, 'extract_flat': 'discard_in_playlist',
-        'dump_single_json': True, 'playlistend': limit if not show_all else None,
-        'quiet': True, 'no_warnings': True,
+        'ignoreerrors': True, 'skip_download': True, 'extract_flat': 'in_playlist',
+        'dump_single_json': True, 'playlistend': limit * 3 if not show_all else None,
+        'quiet': True, 'no_warnings': True, **YDL_NETWORK_OPTS,
     }
-    video_ids = []
+    flat_entries = []
     try:
-        with yt_dlp.YoutubeDL(opts_flat) as ydl:
-            info = ydl.extract_info(url, download=False)
+        # Разовий екземпляр: результат кешується вище, а playlistend у опціях залежить від limit,
+        # тож спільний екземпляр на кожен limit лише множив би незакриті YoutubeDL
+        with yt_dlp.YoutubeDL(opts_flat) as ydl_flat:
+            info = ydl_flat.extract_info(url, download=False)
         if info and 'entries' in info and info['entries']:
-            video_ids = [e['id'] for e in info['entries'] if e and e.get('id')]
+            flat_entries = [e for e in info['entries'] if e and e.get('id')]
         elif info and info.get('id') and not info.get('entries'):
-             st.warning(f"URL {url} схожий на URL одного відео. Ця функція очікує URL каналу.")
-             return []
+             raise FetchError(f"URL {url} схожий на URL одного відео. Ця функція очікує URL каналу.", [])
+    except FetchError:
+        raise
     except Exception as e:
-        st.error(f"Помилка yt_dlp (flat-парсинг) для {url}: {e}")
-        return []
-    if not video_ids:
-        st.warning(f"Не знайдено ID відео для {url} на першому етапі.")
-        return []
+        raise FetchError(f"Помилка yt_dlp (flat-парсинг) для {url}: {e}", [])
+    if not flat_entries:
+        raise FetchError(f"Не знайдено ID відео для {url} на першому етапі.", [])
 
     opts_det = {
         'ignoreerrors': True, 'skip_download': True, 'extract_flat': False,
-        'quiet': True, 'no_warnings': True,
+        'quiet': True, 'no_warnings': True, **YDL_NETWORK_OPTS,
     }
-    videos = []
-    video_ids_to_process = video_ids
-    if not show_all and len(video_ids) > limit * 1.5:
-        video_ids_to_process = video_ids[:int(limit * 1.5)]
+    # Екземпляр yt_dlp не потокобезпечний, тому кожен робочий потік ліниво створює
+    # власний YoutubeDL і перевикористовує його для всіх своїх відео
+    thread_state = threading.local()
+    created_ydls = []
+
+    def _thread_ydl():
+        ydl = getattr(thread_state, 'ydl', None)
+        if ydl is None:
+            ydl = thread_state.ydl = yt_dlp.YoutubeDL(opts_det)
+            created_ydls.append(ydl)
+        return ydl
 
-    for vid_id in video_ids_to_process:
-        if not show_all and len(videos) >= limit: break
+    def _fetch_one(vid_id):
+        """Повертає (відео, помилка, дата публікації) для одного ID; викликається у робочому потоці."""
         vurl = f"https://www.youtube.com/watch?v={vid_id}"
         try:
-            with yt_dlp.YoutubeDL(opts_det) as ydl:
-                vinfo = ydl.extract_info(vurl, download=False)
-            if not vinfo: continue
-            upload_date_str = vinfo.get('upload_date')
-            publish_date = datetime.strptime(upload_date_str, '%Y%m%d').date() if upload_date_str else None
-            if show_all or (publish_date and start_date <= publish_date <= end_date):
-                videos.append({
-                    'title': vinfo.get('title', 'Без назви'), 'views': vinfo.get('view_count', 0),
-                    'likes': vinfo.get('like_count'), 'comments_count': vinfo.get('comment_count'),
-                    'duration': vinfo.get('duration', 0), 'publish_date': publish_date,
-                    'thumbnail_url': vinfo.get('thumbnail'), 'url': vinfo.get('webpage_url', vurl)
-                })
+            vinfo = _thread_ydl().extract_info(vurl, download=False)
+            if not vinfo: return None, None, None
+            publish_date = _parse_yt_date(vinfo.get('upload_date'))
+            if not (show_all or (publish_date and start_date <= publish_date <= end_date)):
+                return None, None, publish_date
+            return {
+                'title': vinfo.get('title', 'Без назви'), 'views': vinfo.get('view_count', 0),
+                'likes': vinfo.get('like_count'), 'comments_count': vinfo.get('comment_count'),
+                'duration': vinfo.get('duration', 0), 'publish_date': publish_date,
+                'thumbnail_url': vinfo.get('thumbnail'), 'url': vinfo.get('webpage_url', vurl)
+            }, None, publish_date
         except Exception as e:
-            st.warning(f"Не вдалося обробити відео {vurl}: {e}")
+            return None, f"Не вдалося обробити відео {vurl}: {e}", None
+
+    def _from_flat_entry(entry):
+        """
+        Повертає (відео, None, дата публікації) з полів flat-запису без окремого запиту yt_dlp
+        або None, якщо запису бракує будь-якого поля, яке дає _fetch_one (перегляди, лайки,
+        коментарі, тривалість, дата), — щоб усі рядки результату мали однаковий вигляд.
+        Flat-записи вкладки каналу YouTube зазвичай не містять лайків, коментарів і дати,
+        тож на практиці цей шлях спрацьовує лише тоді, коли yt_dlp їх таки віддає.
+        """
+        publish_date = _parse_yt_date(entry.get('upload_date'))
+        if publish_date is None or any(entry.get(k) is None for k in FLAT_ENTRY_REQUIRED_FIELDS): return None
+        if not (show_all or start_date <= publish_date <= end_date): return None, None, publish_date
+        return {
+            'title': entry.get('title', 'Без назви'), 'views': entry['view_count'],
+            'likes': entry['like_count'], 'comments_count': entry['comment_count'],
+            'duration': entry['duration'], 'publish_date': publish_date,
+            'thumbnail_url': entry.get('thumbnail') or (entry.get('thumbnails') or [{}])[-1].get('url'),
+            'url': f"https://www.youtube.com/watch?v={entry['id']}"
+        }, None, publish_date
+
+    videos = []
+    failed_urls = []
+    try:
+        with ThreadPoolExecutor(max_workers=YDL_MAX_WORKERS) as ex:
+            # Окремий запит yt_dlp лише для відео, чий flat-запис неповний
+            futures = [_from_flat_entry(e) or ex.submit(_fetch_one, e['id']) for e in flat_entries]
+            # Вкладка /videos впорядкована від нових до старих, тому результати читаються в порядку
+            # подання: щойно трапилось відео, старіше за start_date, решта теж поза діапазоном
+            for fut in futures:
+                video, error_msg, publish_date = fut.result() if isinstance(fut, Future) else fut
+                if error_msg: failed_urls.append(error_msg)
+                if video: videos.append(video)
+                reached_start = publish_date is not None and publish_date < start_date
+                if not show_all and (len(videos) >= limit or reached_start):
+                    for pending in futures:
+                        if isinstance(pending, Future): pending.cancel()
+                    break
+    finally:
+        for ydl in created_ydls: ydl.close()
+    if failed_urls:
+        raise FetchError(f"Не вдалося обробити {len(failed_urls)} відео:\n" + "\n".join(failed_urls), videos)
     return videos
 
+def fetch_video_metadata(channel_id_or_user, start_date, end_date, limit=10, show_all=False):
+    """
+    Метадані відео каналу (див. _fetch_video_metadata_raw); кешуються лише успішні результати.
+    Повертає кортеж (відео, повідомлення про помилку або None).
+    Примітка: ця функція наразі не використовується в основному потоці UI.
+    """
+    if not channel_id_or_user:
+        return [], "Не надано ID каналу або ім'я користувача."
+    try:
+        return _fetch_video_metadata_raw(channel_id_or_user, start_date, end_date, limit, show_all), None
+    except FetchError as e:
+        return e.result, str(e)
 
-def fetch_comments(video_url, pct_str="100%"):
-    if not YT_API_KEY:
-        st.error("Не заданий ключ API YouTube (YOUTUBE_API_KEY) для отримання коментарів.")
-        return []
-    video_id_match = re.search(r"(?:v=|youtu\.be/|shorts/|embed/|watch\?v=|\&v=)([\w-]{11})", video_url)
-    if not video_id_match:
-        video_id = video_url if re.match(r"^[\w-]{11}$", video_url) else None
-        if not video_id:
-            st.error(f"Невірний формат URL або ID відео для коментарів: {video_url}")
-            return []
-    else:
-        video_id = video_id_match.group(1)
 
+def _comments_frame(ids=(), texts=(), likes=()):
+    """Збирає коментарі у DataFrame: колонка likes зберігається як int64 для векторних операцій."""
+    return pd.DataFrame({
+        "id": pd.Series(ids, dtype="object"),
+        "text": pd.Series(texts, dtype="object"),
+        "likes": pd.Series(likes, dtype="int64"),
+    })
+
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _fetch_comments_raw(video_id, target_count, order="time"):
+    """
+    Завантажує до target_count коментарів відео video_id через YouTube Data API
+    у порядку order: "time" (нові спочатку) або "relevance" (за залученістю).
+    Результат кешується, тому функція не звертається до st.*: повертає DataFrame
+    з колонками id/text/likes, а за помилки API піднімає FetchError, щоб вона не потрапила в кеш.
+    Відповіді не запитуються — див. fetch_comment_replies.
+    """
     try:
-        youtube_service = build("youtube", "v3", developerKey=YT_API_KEY)
-        comments_data = []
+        youtube_service = get_youtube_service(YT_API_KEY)
+        ids, texts, likes = [], [], []
         next_page_token = None
-        max_comments_limit = 1000
         while True:
             response = youtube_service.commentThreads().list(
-                part="snippet,replies", videoId=video_id, maxResults=100,
-                pageToken=next_page_token, textFormat="plainText"
+                part="snippet", videoId=video_id, maxResults=min(100, target_count - len(texts)), order=order,
+                pageToken=next_page_token, textFormat="plainText",
+                fields=COMMENT_THREAD_FIELDS
             ).execute()
             for item in response.get("items", []):
                 top_level_comment_snippet = item.get("snippet", {}).get("topLevelComment", {}).get("snippet", {})
-                replies_data = item.get("replies", {}).get("comments", [])
-                comments_data.append({
-                    "text": top_level_comment_snippet.get("textDisplay", ""),
-                    "likes": top_level_comment_snippet.get("likeCount", 0),
-                    "replies": replies_data
-                })
-                if len(comments_data) >= max_comments_limit: break
-            if len(comments_data) >= max_comments_limit or not response.get("nextPageToken"):
+                ids.append(item.get("id"))
+                texts.append(top_level_comment_snippet.get("textDisplay", ""))
+                likes.append(top_level_comment_snippet.get("likeCount", 0))
+                if len(texts) >= target_count: break
+            if len(texts) >= target_count or not response.get("nextPageToken"):
                 break
             next_page_token = response.get("nextPageToken")
-        
-        if pct_str != "100%":
-            try:
-                percentage_to_fetch = float(pct_str.strip('%')) / 100
-                num_to_return = int(len(comments_data) * percentage_to_fetch)
-                random.shuffle(comments_data) 
-                return comments_data[:num_to_return]
-            except ValueError:
-                st.warning(f"Неправильний формат відсотка: {pct_str}. Повертаю всі коментарі.")
-        return comments_data
+        return _comments_frame(ids, texts, likes)
     except Exception as e:
-        st.error(f"Помилка YouTube API при отриманні коментарів: {e}")
-        return []
-
-def gpt_sentiment_analysis(comments_texts_list, model="gpt-3.5-turbo"):
-    if not client: return {"positive": 0, "neutral": 0, "negative": 0, "error": "OpenAI client not initialized."}
-    if not comments_texts_list: return {"positive": 0, "neutral": 0, "negative": 0, "error": "Немає текстів коментарів."}
-    clean_comments_list = [c for c in comments_texts_list if isinstance(c, str) and c.strip()]
-    if not clean_comments_list: return {"positive": 0, "neutral": 0, "negative": 0, "error": "Немає коментарів після очистки."}
-    sample_comments = clean_comments_list[:100]
-    prompt_text = f"""Проаналізуй наступні ютуб-коментарі українською мовою. Порахуй та поверни приблизну кількість:
-- позитивних (positive)
-- нейтральних (neutral)
-- негативних (negative)
-Поверни результат у форматі JSON з ключами "positive", "neutral", "negative". Наприклад: {{"positive": X, "neutral": Y, "negative": Z}}
-Коментарі для аналізу:\n{chr(10).join(sample_comments)}""".strip()
+        raise FetchError(f"Помилка YouTube API при отриманні коментарів: {e}", _comments_frame())
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _fetch_comment_replies_raw(thread_ids):
+    """
+    Завантажує відповіді для кількох гілок коментарів одним запитом commentThreads.list(id=...).
+    Повертає {ID гілки: [відповіді у форматі API]}; за помилки API піднімає FetchError.
+    """
     try:
-        response = client.chat.completions.create(
-            model=model, messages=[{"role": "user", "content": prompt_text}],
-            temperature=0.2, max_tokens=150)
-        api_response_text = response.choices[0].message.content.strip()
-        try:
-            if api_response_text.startswith("```json"): api_response_text = api_response_text[7:]
-            if api_response_text.endswith("```"): api_response_text = api_response_text[:-3]
-            sentiment_results = json.loads(api_response_text)
-            if not all(k in sentiment_results and isinstance(sentiment_results[k], int) for k in ["positive", "neutral", "negative"]):
-                return {"positive": 0, "neutral": 0, "negative": 0, "error": f"GPT JSON структура невірна: {api_response_text}"}
-            return sentiment_results
-        except json.JSONDecodeError: # Резервний парсинг
-            st.warning(f"JSON парсинг GPT відповіді не вдався, спроба текстового парсингу: {api_response_text}")
-            results_fallback = {"positive": 0, "neutral": 0, "negative": 0}
-            for line in api_response_text.lower().splitlines():
-                num = re.findall(r"\d+", line)
-                if not num: continue
-                if "positive" in line: results_fallback["positive"] = int(num[0])
-                elif "neutral" in line: results_fallback["neutral"] = int(num[0])
-                elif "negative" in line: results_fallback["negative"] = int(num[0])
-            if sum(results_fallback.values()) > 0: return results_fallback
-            return {"positive": 0, "neutral": 0, "negative": 0, "error": f"GPT відповідь не розпізнана: {api_response_text}"}
+        response = get_youtube_service(YT_API_KEY).commentThreads().list(
+            part="replies", id=",".join(thread_ids), textFormat="plainText",
+            fields=COMMENT_REPLIES_FIELDS
+        ).execute()
     except Exception as e:
-        return {"positive": 0, "neutral": 0, "negative": 0, "error": str(e)}
+        raise FetchError(f"Помилка YouTube API при отриманні відповідей на коментарі: {e}", {})
+    return {item.get("id"): item.get("replies", {}).get("comments", []) for item in response.get("items", [])}
 
-def gpt_topic_analysis_with_sentiment(comments_texts_list, model="gpt-3.5-turbo"):
-    """Аналізує коментарі, виділяє 5 тем, їх підсумок та тональність."""
-    if not client: return [{"topic": "Помилка", "summary": "Клієнт OpenAI не ініціалізований.", "sentiment": "negative"}]
-    if not comments_texts_list: return []
-    
-    clean_comments_list = [c for c in comments_texts_list if isinstance(c, str) and c.strip()]
-    if not clean_comments_list: return []
+def fetch_comment_replies(thread_ids):
+    """
+    Відповіді для гілок коментарів (див. _fetch_comment_replies_raw); кешуються лише успішні результати.
+    thread_ids — кортеж ID гілок (до 50). Повертає кортеж
+    ({ID гілки: [відповіді у форматі API]}, повідомлення про помилку або None).
+    """
+    if not thread_ids: return {}, None
+    try:
+        return _fetch_comment_replies_raw(thread_ids), None
+    except FetchError as e:
+        return e.result, str(e)
+
+def fetch_comments(video_url, pct_str="100%"):
+    """
+    Завантажує найновіші коментарі до відео через YouTube Data API.
+    pct_str задає частку від ліміту MAX_COMMENTS_LIMIT: пагінація зупиняється, щойно її набрано,
+    тож менша частка означає пропорційно менше запитів і квоти API.
+    Кеш (лише успішних результатів) ведеться в _fetch_comments_raw за ID відео, тож різні форми URL одного відео ділять його.
+    Повертає кортеж (DataFrame з колонками id/text/likes, повідомлення про помилку або None).
+    """
+    if not YT_API_KEY:
+        return _comments_frame(), "Не заданий ключ API YouTube (YOUTUBE_API_KEY) для отримання коментарів."
+    video_id = extract_video_id(video_url)
+    if not video_id:
+        return _comments_frame(), f"Невірний формат URL або ID відео для коментарів: {video_url}"
 
-    sample_size = min(200, len(clean_comments_list)) # Більша вибірка для тем
-    sample_for_topics = random.sample(clean_comments_list, sample_size)
+    pct_warning = None
+    try:
+        target_count = max(1, int(MAX_COMMENTS_LIMIT * float(pct_str.strip('%')) / 100))
+    except ValueError:
+        target_count = MAX_COMMENTS_LIMIT
+        pct_warning = f"Неправильний формат відсотка: {pct_str}. Повертаю всі коментарі."
 
-    prompt_text = f"""
-Проаналізуй надану вибірку з {sample_size} коментарів до YouTube-відео українською мовою.
-Твоє завдання - визначити 5 основних тем або груп думок, що обговорюються в цих коментарях.
-Для кожної з 5 тем:
-1.  Дай коротку, влучну назву темі (2-4 слова).
-2.  Напиши короткий підсумок цієї теми, що відображає суть обговорень (1-2 речення).
-3.  Визнач загальну тональність цієї теми: "positive", "neutral" або "negative".
-
-Поверни результат у форматі JSON-списку об'єктів. Кожен об'єкт має містити ключі "topic" (назва теми), "summary" (підсумок) та "sentiment" (тональність).
-Приклад одного об'єкту в списку:
-  {{
-    "topic": "Якість звуку",
-    "summary": "Багато глядачів відзначили високу якість звуку у відео, що покращило загальне враження.",
-    "sentiment": "positive"
-  }}
-
-Коментарі для аналізу:
-{chr(10).join(sample_for_topics)}
+    try:
+        return _fetch_comments_raw(video_id, target_count, "time"), pct_warning
+    except FetchError as e:
+        return e.result, str(e)
+
+def fetch_top_comment_pool(video_url):
+    """
+    Коментарі-кандидати для топу найпопулярніших: перші TOP_COMMENTS_POOL_SIZE у порядку "relevance",
+    де YouTube ставить коментарі з найбільшою залученістю, — незалежно від частки найновіших,
+    обраної для аналізу. Повертає кортеж (DataFrame з колонками id/text/likes, помилка або None);
+    відсутній ключ чи невірний URL не вважаються помилкою тут — про них повідомляє fetch_comments.
+    """
+    video_id = extract_video_id(video_url)
+    if not YT_API_KEY or not video_id: return _comments_frame(), None
+    try:
+        return _fetch_comments_raw(video_id, TOP_COMMENTS_POOL_SIZE, "relevance"), None
+    except FetchError as e:
+        return e.result, str(e)
+
+def _prep_for_llm(comments_texts_list):
+    """
+    Готує коментарі до відправки в GPT: стискає пробільні символи (зокрема переноси рядків,
+    щоб у промпті кожен коментар займав один рядок), обрізає до LLM_COMMENT_MAX_CHARS символів,
+    відкидає короткі (< 3 символів) та емодзі-коментарі і дублікати
+    (за 8-байтовим blake2b-хешем перших 64 символів у нижньому регістрі).
+    Генератор: вибірка може зупинитися раніше, не обробляючи весь список.
+    """
+    seen_digests = set()
+    for c in comments_texts_list:
+        if not isinstance(c, str): continue
+        text = " ".join(c.split())[:LLM_COMMENT_MAX_CHARS]
+        if len(text) < 3 or not any(ch.isalnum() for ch in text): continue
+        digest = hashlib.blake2b(text[:64].lower().encode(), digest_size=8).digest()
+        if digest in seen_digests: continue
+        seen_digests.add(digest)
+        yield text
+
+def _reservoir_sample(iterable, k, rng=random):
+    """
+    Рівномірна випадкова вибірка до k елементів за один прохід (алгоритм R), пам'ять O(k).
+    rng — джерело випадковості (модуль random або засіяний random.Random для відтворюваної вибірки).
+    """
+    reservoir = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(i + 1)
+            if j < k: reservoir[j] = item
+    return reservoir
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoding(model):
+    """Токенізатор tiktoken для моделі, спільний для всіх перезапусків скрипта."""
+    return tiktoken.encoding_for_model(model)
+
+def _pack_by_tokens(comments, budget_tokens, model=DEFAULT_MODEL):
+    """
+    Бере коментарі по черзі, доки їхня сумарна довжина в токенах (+2 на розділювач)
+    не перевищить budget_tokens. encode_ordinary не падає на спецтокенах у тексті коментаря.
+    Якщо токенізатор недоступний (tiktoken завантажує словник BPE при першому використанні),
+    довжина оцінюється в символах (~4 символи на токен), щоб аналіз не зривався.
+    """
+    try:
+        token_counts = [len(tokens) for tokens in get_token_encoding(model).encode_ordinary_batch(comments)]
+    except Exception:
+        token_counts = [len(comment) // 4 + 1 for comment in comments]
+    packed, used = [], 0
+    for comment, token_count in zip(comments, token_counts):
+        used += token_count + 2
+        if used > budget_tokens: break
+        packed.append(comment)
+    return packed
+
+def _llm_sample(comments_texts_list, k, budget_tokens, model=DEFAULT_MODEL, rng=random):
+    """Вибірка для промпту GPT: очистка (_prep_for_llm), до k випадкових коментарів (з rng), бюджет токенів."""
+    return _pack_by_tokens(_reservoir_sample(_prep_for_llm(comments_texts_list), k, rng), budget_tokens, model)
+
+def _comments_prompt_prefix(sample_comments):
+    """
+    Спільний початок промптів аналізу коментарів: спершу блок коментарів, потім завдання.
+    За однакової вибірки (див. fetch_comments_and_start_analysis) префікс збігається між
+    повторними аналізами того самого відео, і OpenAI може взяти його з кешу промптів.
+    """
+    return "Ось вибірка коментарів під відео з YouTube:\n" + "\n".join(sample_comments) + "\n\nЗавдання:\n"
+
+def gpt_full_comment_report(comments_texts_list, model=DEFAULT_MODEL, include_summary=True, presampled=False):
+    """
+    Один запит до GPT замість трьох: загальна тональність, 5 основних тем і підсумок коментарів.
+    Повертає {"sentiment": {...}, "topics": [...], "summary": str}; якщо запит не вдався —
+    кожна частина містить опис помилки у форматі відповідної окремої функції.
+    include_summary=False не просить у GPT підсумок (summary буде None) — для UI,
+    що показує підсумок потоково через gpt_comment_summary(stream=True).
+    presampled=True означає, що це вже готова вибірка (_llm_sample), яка йде у промпт без змін.
+    """
+    def _failed(error_msg, topics_on_error=True):
+        return {
+            "sentiment": {"positive": 0, "neutral": 0, "negative": 0, "error": error_msg},
+            "topics": [{"topic": "Помилка", "summary": error_msg, "sentiment": "negative"}] if topics_on_error else [],
+            "summary": f"⚠️ {error_msg}",
+        }
+
+    if not client: return _failed("Клієнт OpenAI не ініціалізований.")
+    if not comments_texts_list: return _failed("Немає текстів коментарів.", topics_on_error=False)
+    sample_comments = comments_texts_list if presampled else _llm_sample(
+        comments_texts_list, 200, LLM_REPORT_TOKEN_BUDGET, model)
+    if not sample_comments: return _failed("Немає коментарів після очистки.", topics_on_error=False)
+    if len(sample_comments) < LLM_MIN_COMMENTS:
+        too_few_msg = f"Замало коментарів для аналізу GPT ({len(sample_comments)})."
+        return {
+            "sentiment": {"positive": 0, "neutral": 0, "negative": 0, "error": too_few_msg}, "topics": [],
+            "summary": "\n".join(f"- {c}" for c in sample_comments) if include_summary else None,
+        }
+
+    summary_task = """
+3. Підсумок (markdown, українською):
+   - короткий аналіз найпопулярніших тем або настроїв (2-3 речення);
+   - що найбільше сподобалось глядачам, що залишило нейтральне враження, що викликало негатив чи критику (по 1-2 речення);
+   - короткий висновок про загальне враження аудиторії (1-2 речення).""" if include_summary else ""
+    summary_schema = ',\n  "summary": "підсумок"' if include_summary else ""
+    prompt_text = _comments_prompt_prefix(sample_comments) + f"""
+Проаналізуй наведену вище вибірку з {len(sample_comments)} коментарів українською мовою та виконай {"три завдання" if include_summary else "два завдання"}.
+
+1. Тональність: порахуй приблизну кількість позитивних (positive), нейтральних (neutral) та негативних (negative) коментарів.
+2. Теми: визнач 5 основних тем або груп думок. Для кожної теми дай коротку назву (2-4 слова),
+   підсумок суті обговорень (1-2 речення) та загальну тональність: "positive", "neutral" або "negative".{summary_task}
+
+Відповідай ЛИШЕ JSON-об'єктом такої структури:
+{{"sentiment": {{"positive": int, "neutral": int, "negative": int}},
+  "topics": [{{"topic": "назва", "summary": "підсумок", "sentiment": "positive|neutral|negative"}}, ...]{summary_schema}}}
 """.strip()
     try:
         response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt_text}],
-            temperature=0.5,
-            max_tokens=1500 # Більше токенів для детального аналізу тем
-        )
-        api_response_text = response.choices[0].message.content.strip()
-        try:
-            if api_response_text.startswith("```json"): api_response_text = api_response_text[7:]
-            if api_response_text.endswith("```"): api_response_text = api_response_text[:-3]
-            topics_data = json.loads(api_response_text)
-            if not isinstance(topics_data, list) or not all(
-                isinstance(t, dict) and all(k in t for k in ["topic", "summary", "sentiment"]) for t in topics_data
-            ):
-                st.warning(f"GPT повернув JSON для тем, але структура невірна: {api_response_text}")
-                return [{"topic": "Помилка парсингу", "summary": "Не вдалося розібрати структуру відповіді від GPT.", "sentiment": "negative"}]
-            return topics_data[:5] # Повертаємо максимум 5 тем
-        except json.JSONDecodeError:
-            st.error(f"Не вдалося розпарсити JSON відповідь від GPT для аналізу тем: {api_response_text}")
-            return [{"topic": "Помилка JSON", "summary": "GPT повернув невалідний JSON.", "sentiment": "negative"}]
+            model=model, messages=[{"role": "user", "content": prompt_text}],
+            temperature=0, max_tokens=2000 if include_summary else 800, response_format={"type": "json_object"})
+        api_response_text = response.choices[0].message.content
     except Exception as e:
-        st.error(f"Помилка GPT при аналізі тем: {e}")
-        return [{"topic": "Помилка GPT", "summary": str(e), "sentiment": "negative"}]
+        return _failed(f"Помилка GPT: {e}")
+    try:
+        report = json.loads(api_response_text)
+    except json.JSONDecodeError:
+        return _failed(f"GPT повернув невалідний JSON: {api_response_text}")
+
+    sentiment = report.get("sentiment")
+    if not (isinstance(sentiment, dict) and all(isinstance(sentiment.get(k), int) for k in ["positive", "neutral", "negative"])):
+        sentiment = {"positive": 0, "neutral": 0, "negative": 0, "error": f"GPT JSON структура тональності невірна: {sentiment}"}
+    topics = report.get("topics")
+    if not isinstance(topics, list) or not all(
+        isinstance(t, dict) and all(k in t for k in ["topic", "summary", "sentiment"]) for t in topics
+    ):
+        topics = [{"topic": "Помилка парсингу", "summary": "Не вдалося розібрати структуру тем від GPT.", "sentiment": "negative"}]
+    summary = report.get("summary")
+    if not include_summary:
+        summary = None
+    elif not isinstance(summary, str) or not summary.strip():
+        summary = "⚠️ GPT не повернув підсумок коментарів."
+    else:
+        summary = summary.strip()
+    return {"sentiment": sentiment, "topics": topics[:5], "summary": summary}
+
+def gpt_sentiment_analysis(comments_texts_list, model=DEFAULT_MODEL):
+    """Загальна тональність коментарів; обгортка над gpt_full_comment_report."""
+    return gpt_full_comment_report(comments_texts_list, model, include_summary=False)["sentiment"]
 
-def gpt_analyze_comment_popularity(comment_text, replies_texts_list, model="gpt-3.5-turbo"):
+def gpt_topic_analysis_with_sentiment(comments_texts_list, model=DEFAULT_MODEL):
+    """Аналізує коментарі, виділяє 5 тем, їх підсумок та тональність; обгортка над gpt_full_comment_report."""
+    return gpt_full_comment_report(comments_texts_list, model, include_summary=False)["topics"]
+
+def gpt_analyze_comment_popularity(comment_text, replies_texts_list, model=DEFAULT_MODEL):
     """Аналізує окремий коментар та його відповіді, щоб припустити причину популярності."""
     if not client: return "Клієнт OpenAI не ініціалізований."
     if not comment_text: return "Текст коментаря порожній."
@@ -287,33 +666,258 @@ def gpt_analyze_comment_popularity(comment_text, replies_texts_list, model="gpt-
         st.error(f"Помилка GPT при аналізі популярності коментаря: {e}")
         return f"⚠️ Помилка GPT: {e}"
 
+def gpt_analyze_comments_popularity_batch(items, model=DEFAULT_MODEL):
+    """
+    Пакетний варіант gpt_analyze_comment_popularity: один запит до GPT для всіх коментарів.
+    items — список словників {"idx": int, "text": str, "replies": [str, ...]}.
+    Повертає словник {idx: гіпотеза}; для коментарів без відповіді GPT — повідомлення про помилку.
+    """
+    if not items: return {}
+    if not client: return {item["idx"]: "Клієнт OpenAI не ініціалізований." for item in items}
+
+    comments_block = "\n\n".join(
+        f"Коментар {item['idx']}: \"{item['text']}\"\n"
+        f"Відповіді {item['idx']} (до 5):\n"
+        + ("\n".join(f"- {r}" for r in item["replies"][:5]) if item["replies"] else "Відповідей немає.")
+        for item in items
+    )
+    prompt_text = f"""
+Проаналізуй наступні коментарі з YouTube та відповіді під ними (якщо є).
 
-def gpt_comment_summary(comments_texts_list, model="gpt-3.5-turbo"):
-    if not client: return "Клієнт OpenAI не ініціалізований."
-    if not comments_texts_list: return "Немає коментарів для підсумку."
-    clean_comments_list = [c for c in comments_texts_list if isinstance(c, str) and c.strip()]
-    if not clean_comments_list: return "Немає коментарів після очистки для підсумку."
-    sample_size = min(100, len(clean_comments_list))
-    sample_for_summary = random.sample(clean_comments_list, sample_size)
-    prompt_text = f"""Тобі надано вибірку з {sample_size} коментарів під відео з YouTube українською мовою.
+{comments_block}
+
+Для кожного коментаря на основі його тексту та відповідей коротко (1-3 речення) вислови гіпотезу, чому він міг стати популярним (набрав багато лайків).
+Зверни увагу на можливі причини: гумор, влучність, згода з більшістю, оригінальність думки, актуальність, провокативність, запитання, що викликало дискусію, тощо.
+Відповідь дай українською мовою у форматі JSON: {{"results": [{{"idx": номер коментаря, "analysis": "гіпотеза"}}, ...]}}
+""".strip()
+    try:
+        response = client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt_text}],
+            temperature=0.6,
+            max_tokens=200 * len(items),
+            response_format={"type": "json_object"}
+        )
+        api_response_text = response.choices[0].message.content
+        results = json.loads(api_response_text).get("results", [])
+    except Exception as e:
+        return {item["idx"]: f"⚠️ Помилка GPT: {e}" for item in items}
+    # JSON-режим не гарантує типів: idx може прийти рядком ("1"), тому він зводиться до int
+    analyses = {}
+    for r in results if isinstance(results, list) else []:
+        if not (isinstance(r, dict) and "analysis" in r): continue
+        try: analyses[int(r.get("idx"))] = r["analysis"]
+        except (TypeError, ValueError): continue
+    return {item["idx"]: analyses.get(item["idx"], "GPT не повернув аналіз для цього коментаря.") for item in items}
+
+
+def _build_summary_prompt(comments_texts_list, model=DEFAULT_MODEL, presampled=False):
+    """
+    Повертає (промпт для підсумку, None) або (None, текст замість підсумку): повідомлення, чому підсумок
+    неможливий, або сам список коментарів, якщо їх менше за LLM_MIN_COMMENTS.
+    """
+    if not client: return None, "Клієнт OpenAI не ініціалізований."
+    if not comments_texts_list: return None, "Немає коментарів для підсумку."
+    sample_for_summary = comments_texts_list if presampled else _llm_sample(
+        comments_texts_list, 100, LLM_SUMMARY_TOKEN_BUDGET, model)
+    if not sample_for_summary: return None, "Немає коментарів після очистки для підсумку."
+    if len(sample_for_summary) < LLM_MIN_COMMENTS: return None, "\n".join(f"- {c}" for c in sample_for_summary)
+    sample_size = len(sample_for_summary)
+    prompt_text = _comments_prompt_prefix(sample_for_summary) + f"""Наведено вибірку з {sample_size} коментарів українською мовою.
 1. Напиши короткий аналіз найпопулярніших тем або настроїв у цих коментарях (2-3 речення).
 2. Узагальни (по 1-2 речення на кожен пункт):
    - Що найбільше сподобалось глядачам (якщо це видно з коментарів)?
    - Що залишило нейтральне враження або було менш обговорюваним?
    - Що викликало негатив чи критику (якщо є)?
-3. Зроби короткий висновок (1-2 речення) про загальне враження аудиторії.
-Коментарі:\n{chr(10).join(sample_for_summary)}""".strip()
+3. Зроби короткий висновок (1-2 речення) про загальне враження аудиторії.""".strip()
+    return prompt_text, None
+
+def gpt_comment_summary(comments_texts_list, model=DEFAULT_MODEL, stream=False, presampled=False):
+    """
+    Загальний підсумок коментарів; обгортка над gpt_full_comment_report.
+    stream=True повертає генератор фрагментів тексту (gpt_comment_summary_stream) для st.write_stream.
+    """
+    if stream: return gpt_comment_summary_stream(comments_texts_list, model, presampled)
+    return gpt_full_comment_report(comments_texts_list, model, presampled=presampled)["summary"]
+
+def gpt_comment_summary_stream(comments_texts_list, model=DEFAULT_MODEL, presampled=False):
+    """Потоковий варіант gpt_comment_summary: генератор фрагментів тексту для st.write_stream."""
+    prompt_text, error_msg = _build_summary_prompt(comments_texts_list, model, presampled)
+    if error_msg:
+        yield error_msg
+        return
     try:
-        response = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model=model, messages=[{"role": "user", "content": prompt_text}],
-            temperature=0.7, max_tokens=800)
-        return response.choices[0].message.content.strip()
+            temperature=0.7, max_tokens=800, stream=True)
+        for chunk in stream:
+            if chunk.choices: yield chunk.choices[0].delta.content or ""
+    except Exception as e:
+        yield f"⚠️ Помилка GPT (підсумок): {e}"
+
+@st.cache_resource
+def _ydl_thread_state():
+    """threading.local з екземплярами YoutubeDL потоків, спільний для всіх перезапусків скрипта."""
+    return threading.local()
+
+def get_ydl(opts):
+    """
+    YoutubeDL поточного потоку для набору опцій. Екземпляр yt_dlp не потокобезпечний, тому кожен
+    потік ліниво створює власний — без спільного замка, тож повільний запит однієї сесії не блокує інші.
+    Викликати лише з потоків пулу get_io_executor: вони довгоживучі, тож екземпляри перевикористовуються
+    і їх не більше IO_MAX_WORKERS на набір опцій. Потік скрипта Streamlit створюється заново на кожен
+    запуск, і там кожен виклик лишав би новий незакритий екземпляр.
+    """
+    state = _ydl_thread_state()
+    ydls = getattr(state, 'ydls', None)
+    if ydls is None: ydls = state.ydls = {}
+    key = ydl_opts_key(opts)
+    if key not in ydls: ydls[key] = yt_dlp.YoutubeDL(opts)
+    return ydls[key]
+
+def ydl_opts_key(opts):
+    """Стабільний хешований ключ набору опцій для get_ydl."""
+    return json.dumps(opts, sort_keys=True)
+
+@st.cache_resource
+def get_io_executor():
+    """Спільний пул потоків для незалежних мережевих викликів (yt_dlp, YouTube API, OpenAI)."""
+    return ThreadPoolExecutor(max_workers=IO_MAX_WORKERS)
+
+def submit_with_script_ctx(executor, fn, *args, **kwargs):
+    """Запускає fn у пулі потоків, передаючи потоку контекст Streamlit-скрипта, щоб працювали виклики st.*."""
+    ctx = get_script_run_ctx()
+    def _run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return executor.submit(_run)
+
+def _extract_video_details(video_url):
+    """
+    Дані одного відео з yt_dlp (через get_ydl) — лише поля VIDEO_DETAILS_FIELDS, які показує UI,
+    щоб кеш не зберігав повний info-словник з форматами.
+    Повертає кортеж (дані або None, повідомлення про помилку або None); порожня відповідь yt_dlp
+    (з ignoreerrors він не піднімає винятків) теж вважається помилкою.
+    """
+    try:
+        info = get_ydl(VIDEO_DETAILS_YDL_OPTS).extract_info(video_url, download=False)
     except Exception as e:
-        return f"⚠️ Помилка GPT (підсумок): {e}"
+        return None, f"Помилка yt_dlp (дані відео): {e}"
+    if not info: return None, f"yt_dlp не повернув даних для відео: {video_url}"
+    return {k: info[k] for k in VIDEO_DETAILS_FIELDS if k in info}, None
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _cached_video_details(video_id):
+    """
+    Дані відео за ID: спершу з дискового кешу VIDEO_DETAILS_CACHE_DIR (якщо запис свіжіший
+    за VIDEO_DETAILS_CACHE_TTL), інакше з yt_dlp із записом результату на диск.
+    Помилки читання чи запису кешу не перешкоджають отриманню даних; невдача yt_dlp
+    піднімає FetchError, щоб не потрапити ні в кеш пам'яті, ні на диск.
+    """
+    cache_path = os.path.join(VIDEO_DETAILS_CACHE_DIR, f"{video_id}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) < VIDEO_DETAILS_CACHE_TTL:
+            with open(cache_path, encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    details, error = _extract_video_details(f"https://www.youtube.com/watch?v={video_id}")
+    if error: raise FetchError(error)
+    try:
+        os.makedirs(VIDEO_DETAILS_CACHE_DIR, exist_ok=True)
+        # Унікальний тимчасовий файл: сесії Streamlit — потоки одного процесу, тож ім'я за PID спільне
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=VIDEO_DETAILS_CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(details, f, ensure_ascii=False)
+        os.replace(f.name, cache_path)
+    except OSError:
+        pass
+    return details
+
+def fetch_video_details(video_url):
+    """
+    Дані відео для обробника аналізу. Кеш ведеться за ID відео (_cached_video_details, лише успішні
+    результати), тож різні форми URL одного відео ділять його; URL без розпізнаного ID йдуть напряму в yt_dlp.
+    Викликається в потоці пулу get_io_executor (див. get_ydl).
+    Повертає кортеж (дані або None, повідомлення про помилку або None).
+    """
+    video_id = extract_video_id(video_url)
+    if not video_id: return _extract_video_details(video_url)
+    try:
+        return _cached_video_details(video_id), None
+    except FetchError as e:
+        return e.result, str(e)
+
+def prepare_top_comments(comments_df, top_n=10):
+    """
+    Вибирає top_n коментарів за лайками, одним запитом довантажує їхні відповіді
+    й один раз проходить по них. Повертає кортеж (список словників {"idx", "text", "likes",
+    "replies" (тексти для GPT), "top_replies" (до 3 пар (лайки, текст))} — придатний для
+    gpt_analyze_comments_popularity_batch, повідомлення про помилку або None).
+    """
+    comments_with_likes = comments_df[comments_df['likes'].notna()]
+    top_rows = list(comments_with_likes.nlargest(top_n, 'likes').itertuples(index=False))
+    replies_by_thread, replies_error = fetch_comment_replies(tuple(row.id for row in top_rows if row.id))
+    top_comments = []
+    for i, comment_detail in enumerate(top_rows):
+        replies_texts, replies_by_likes = [], []
+        for reply_item in replies_by_thread.get(comment_detail.id, []):
+            reply_snippet = reply_item.get("snippet") if isinstance(reply_item, dict) else None
+            if not isinstance(reply_snippet, dict): continue
+            reply_text = reply_snippet.get("textDisplay")
+            if not reply_text: continue
+            replies_texts.append(reply_text)
+            reply_likes = reply_snippet.get("likeCount")
+            if isinstance(reply_likes, int): replies_by_likes.append((reply_likes, reply_text))
+        top_comments.append({
+            "idx": i + 1, "text": comment_detail.text, "likes": int(comment_detail.likes),
+            "replies": replies_texts, "top_replies": heapq.nlargest(3, replies_by_likes),
+        })
+    return top_comments, replies_error
+
+def fetch_comments_and_start_analysis(executor, video_url, pct_str):
+    """
+    Завантажує коментарі й одразу паралельно запускає у фоні обидва незалежні GPT-запити:
+    звіт (тональність і теми) та аналіз популярності топ-10 коментарів,
+    не чекаючи на дані відео від yt_dlp. Виконується у пулі через submit_with_script_ctx.
+    Повертає словник з ключами comments, error, texts, llm_sample (спільна вибірка для GPT), top_comments, report і popularity
+    (останні два — future або None, якщо аналізувати нічого).
+    """
+    comments_df, comments_error = fetch_comments(video_url, pct_str=pct_str)
+    texts = comments_df["text"]
+    comment_texts = texts[texts.str.strip().str.len().gt(0)].tolist()
+    # Вибірка для GPT формується один раз і спільна для звіту й потокового підсумку. Генератор
+    # засіяно ID відео: за тих самих (кешованих) коментарів повторний аналіз дає ту саму вибірку,
+    # а отже й префікс промпту, який OpenAI може взяти з кешу. Звіт і підсумок у межах одного
+    # запуску йдуть одночасно, тож між ними кеш спрацьовує не гарантовано
+    llm_sample = _llm_sample(comment_texts, 200, LLM_REPORT_TOKEN_BUDGET,
+                             rng=random.Random(extract_video_id(video_url) or video_url))
+    # Звіт стартує до довантаження відповідей топ-коментарів — він від них не залежить
+    # Підсумок UI показує потоково (gpt_comment_summary(stream=True)), тому у звіті він не потрібен
+    report_future = submit_with_script_ctx(
+        executor, gpt_full_comment_report, llm_sample, include_summary=False, presampled=True) if comment_texts else None
+    # Топ береться з вибірки "relevance", а не лише з найновіших коментарів; якщо вона недоступна —
+    # з уже завантажених. Запит послідовний: вкладене очікування на пул могло б його заблокувати
+    # Якщо коментарі взагалі не завантажились (напр. вимкнені), повторний запит дав би ту саму помилку
+    if comments_df.empty and comments_error: top_pool_df, top_pool_error = _comments_frame(), None
+    else: top_pool_df, top_pool_error = fetch_top_comment_pool(video_url)
+    top_comments, replies_error = prepare_top_comments(top_pool_df if not top_pool_df.empty else comments_df)
+    errors = "\n".join(filter(None, (comments_error, top_pool_error, replies_error)))
+    return {
+        "comments": comments_df, "error": errors or None, "texts": comment_texts, "llm_sample": llm_sample,
+        "top_comments": top_comments, "report": report_future,
+        "popularity": submit_with_script_ctx(executor, gpt_analyze_comments_popularity_batch, top_comments) if top_comments else None,
+    }
+
+def fmt_int(n):
+    """Ціле число з розділювачами тисяч; для відсутнього чи нечислового значення — "N/A"."""
+    return f"{n:,}" if isinstance(n, int) else "N/A"
 
 def format_duration(seconds_total):
-    if not isinstance(seconds_total, (int, float)) or seconds_total < 0: return "00:00:00"
-    h, rem = divmod(int(seconds_total), 3600)
+    try: total = int(seconds_total)
+    except (TypeError, ValueError, OverflowError): return "00:00:00"
+    if total < 0: return "00:00:00"
+    h, rem = divmod(total, 3600)
     m, s = divmod(rem, 60)
     return f"{h:02}:{m:02}:{s:02}"
 
@@ -321,7 +925,7 @@ def format_duration(seconds_total):
 video_url_input = st.text_input("URL відео для аналізу:", placeholder="Вставте URL YouTube відео...", key="main_video_url_input")
 comments_percentage_options = {"Всі": "100%", "50%": "50%", "25%": "25%", "10%": "10%"}
 selected_display_percentage = st.selectbox(
-    "Яку частку коментарів аналізувати (випадкова вибірка):",
+    "Яку частку коментарів аналізувати (від 1000 найновіших):",
     list(comments_percentage_options.keys()), index=0, key="comments_percentage_selector")
 percentage_to_fetch_str = comments_percentage_options[selected_display_percentage]
 
@@ -329,17 +933,22 @@ if st.button("🚀 Проаналізувати відео", key="analyze_this_v
     if not video_url_input:
         st.error("Будь ласка, введіть URL відео для аналізу.")
     else:
-        with st.spinner("Збір даних про відео..."):
-            video_details = None
-            try:
-                ydl_opts_video = {'quiet': True, 'no_warnings': True, 'skip_download': True, 'ignoreerrors': True, 'extract_flat': False}
-                with yt_dlp.YoutubeDL(ydl_opts_video) as ydl:
-                    video_details = ydl.extract_info(video_url_input, download=False)
-            except Exception as e:
-                st.error(f"Помилка yt_dlp (дані відео): {e}")
+        # Коментарі та GPT-аналізи не залежать від даних yt_dlp: ланцюжок "коментарі -> тональність/теми"
+        # стартує одразу і йде паралельно із завантаженням даних відео
+        io_executor = get_io_executor()
+        comments_future = submit_with_script_ctx(
+            io_executor, fetch_comments_and_start_analysis, io_executor, video_url_input, percentage_to_fetch_str)
+        analysis_status = st.status("Збір даних про відео та коментарів...", expanded=False)
+        # yt_dlp виконується в довгоживучому потоці пулу, де get_ydl перевикористовує екземпляр
+        video_details, video_details_error = submit_with_script_ctx(
+            io_executor, fetch_video_details, video_url_input).result()
+        # Аналіз коментарів від даних yt_dlp не залежить і вже запущений, тому він показується
+        # і тоді, коли дані відео отримати не вдалося
         if not video_details:
-            st.error(f"Не вдалося отримати інформацію для відео: {video_url_input}")
+            analysis_status.update(label="Не вдалося отримати дані відео, завантаження коментарів...")
+            st.error(video_details_error or f"Не вдалося отримати інформацію для відео: {video_url_input}")
         else:
+            analysis_status.update(label="Дані відео отримано, завантаження коментарів...")
             st.subheader(f"Аналіз відео: {video_details.get('title', 'Без назви')}")
             col_thumb, col_info = st.columns([1, 3])
             with col_thumb:
@@ -347,53 +956,70 @@ if st.button("🚀 Проаналізувати відео", key="analyze_this_v
             with col_info:
                 st.markdown(f"**Назва:** {video_details.get('title', 'N/A')}")
                 st.markdown(f"**Тривалість:** {format_duration(video_details.get('duration', 0))}")
-                st.markdown(f"**Перегляди:** {video_details.get('view_count', 0):,}")
-                st.markdown(f"**Лайки:** {video_details.get('like_count', 0):,}")
-                st.markdown(f"**Коментарі (yt-dlp):** {video_details.get('comment_count', 'N/A'):,}")
+                st.markdown(f"**Перегляди:** {fmt_int(video_details.get('view_count'))}")
+                st.markdown(f"**Лайки:** {fmt_int(video_details.get('like_count'))}")
+                st.markdown(f"**Коментарі (yt-dlp):** {fmt_int(video_details.get('comment_count'))}")
                 upload_date_str = video_details.get('upload_date')
-                if upload_date_str:
-                    try: st.markdown(f"**Дата публікації:** {datetime.strptime(upload_date_str, '%Y%m%d').strftime('%d.%m.%Y')}")
-                    except ValueError: st.markdown(f"**Дата публікації:** {upload_date_str} (не розпарсено)")
+                publish_date = _parse_yt_date(upload_date_str)
+                if publish_date: st.markdown(f"**Дата публікації:** {publish_date.strftime('%d.%m.%Y')}")
+                elif upload_date_str: st.markdown(f"**Дата публікації:** {upload_date_str} (не розпарсено)")
                 else: st.markdown("**Дата публікації:** N/A")
-            st.markdown("---")
-            st.subheader("📈 Аналіз коментарів до відео")
-            with st.spinner(f"Завантаження та аналіз ~{selected_display_percentage} коментарів..."):
-                fetched_comments_data = fetch_comments(video_url_input, pct_str=percentage_to_fetch_str)
+        st.markdown("---")
+        st.subheader("📈 Аналіз коментарів до відео")
+        with st.spinner(f"Завантаження та аналіз ~{selected_display_percentage} коментарів..."):
+            comments_analysis = comments_future.result()
+        fetched_comments_data, comments_error = comments_analysis["comments"], comments_analysis["error"]
+        comment_texts_for_gpt = comments_analysis["texts"]
+        analysis_status.update(label="Коментарі завантажено, GPT аналізує...")
+        if comments_error:
+            if not fetched_comments_data.empty: st.warning(comments_error)
+            else: st.error(comments_error)
+
+        if fetched_comments_data.empty:
+            st.info("Коментарі до цього відео не знайдено, не вдалося завантажити, або обрано 0%.")
+        else:
+            st.info(f"Завантажено та буде проаналізовано приблизно {len(fetched_comments_data)} коментарів.")
 
-            if not fetched_comments_data:
-                st.info("Коментарі до цього відео не знайдено, не вдалося завантажити, або обрано 0%.")
+            if not comment_texts_for_gpt:
+                st.warning("Текстовий вміст коментарів для аналізу відсутній або порожній.")
             else:
-                st.info(f"Завантажено та буде проаналізовано приблизно {len(fetched_comments_data)} коментарів.")
-                comment_texts_for_gpt = [c.get("text", "") for c in fetched_comments_data if isinstance(c, dict) and isinstance(c.get("text"), str) and c.get("text").strip()]
+                sentiment_section, topics_section, summary_section = st.container(), st.container(), st.container()
 
-                if not comment_texts_for_gpt:
-                    st.warning("Текстовий вміст коментарів для аналізу відсутній або порожній.")
-                else:
-                    # 1. Аналіз тональності загалом
+                # 3. Загальний підсумок коментарів — потоково, поки звіт тональності й тем рахується у фоні
+                with summary_section:
+                    st.markdown("##### 📝 Загальний підсумок коментарів (за версією GPT):")
+                    st.write_stream(gpt_comment_summary(comments_analysis["llm_sample"], stream=True, presampled=True))
+
+                # Тональність і теми — один GPT-звіт, що вже рахується у фоні
+                # (див. fetch_comments_and_start_analysis)
+                with st.spinner("GPT аналізує тональність і теми коментарів..."):
+                    comment_report = comments_analysis["report"].result()
+
+                # 1. Аналіз тональності загалом
+                with sentiment_section:
                     st.markdown("##### Тональність коментарів (загальна оцінка GPT):")
-                    with st.spinner("GPT аналізує загальну тональність..."):
-                         sentiment_gpt_result = gpt_sentiment_analysis(comment_texts_for_gpt)
-                    
+                    sentiment_gpt_result = comment_report["sentiment"]
+                
                     total_sentiments = sum(v for k,v in sentiment_gpt_result.items() if k != "error" and isinstance(v,int))
                     if total_sentiments > 0:
                         pos_pct = (sentiment_gpt_result.get('positive', 0) / total_sentiments) * 100
                         neu_pct = (sentiment_gpt_result.get('neutral', 0) / total_sentiments) * 100
                         neg_pct = (sentiment_gpt_result.get('negative', 0) / total_sentiments) * 100
-                        bar_len = 20
-                        pos_bar = "🟩" * int(bar_len * pos_pct / 100)
-                        neu_bar = "🟨" * int(bar_len * neu_pct / 100)
-                        neg_bar = "🟥" * max(0, bar_len - len(pos_bar) - len(neu_bar))
-                        st.markdown(f"{pos_bar}{neu_bar}{neg_bar} Поз: {pos_pct:.0f}% | Нейт: {neu_pct:.0f}% | Нег: {neg_pct:.0f}%")
+                        # Ширина колонок пропорційна частці; st.columns не приймає нульових ширин
+                        bar_parts = [(pct, box, label) for pct, box, label in (
+                            (pos_pct, st.success, "Поз"), (neu_pct, st.warning, "Нейт"), (neg_pct, st.error, "Нег")) if pct > 0]
+                        for column, (pct, box, label) in zip(st.columns([pct for pct, _, _ in bar_parts]), bar_parts):
+                            with column: box(f"{label} {pct:.0f}%")
                     if sentiment_gpt_result.get("error"):
                         st.caption(f"Примітка (тональність): {sentiment_gpt_result['error']}")
                     elif total_sentiments == 0 and "error" not in sentiment_gpt_result:
                         st.info("GPT не зміг визначити чітку тональність для наданої вибірки коментарів.")
 
-                    # 2. Аналіз 5 основних тем
+                # 2. Аналіз 5 основних тем
+                with topics_section:
                     st.markdown("##### 💬 Основні теми в коментарях (аналіз GPT):")
-                    with st.spinner("GPT виділяє основні теми в коментарях..."):
-                        topic_analysis_results = gpt_topic_analysis_with_sentiment(comment_texts_for_gpt)
-                    
+                    topic_analysis_results = comment_report["topics"]
+                
                     if topic_analysis_results:
                         for topic_item in topic_analysis_results:
                             sentiment_color = {"positive": "green", "neutral": "orange", "negative": "red"}.get(topic_item.get("sentiment", "neutral"), "grey")
@@ -406,39 +1032,25 @@ if st.button("🚀 Проаналізувати відео", key="analyze_this_v
                     else:
                         st.info("Не вдалося виділити основні теми з коментарів.")
 
-                    # 3. Загальний підсумок коментарів
-                    st.markdown("##### 📝 Загальний підсумок коментарів (за версією GPT):")
-                    with st.spinner("GPT генерує підсумок коментарів..."):
-                        summary_from_gpt = gpt_comment_summary(comment_texts_for_gpt)
-                    st.markdown(summary_from_gpt)
-
-                    # 4. Топ-10 коментарів з аналізом популярності
-                    st.markdown("##### 🔥 Топ-10 найпопулярніших коментарів (за лайками) та аналіз їх популярності:")
-                    comments_with_likes = [c for c in fetched_comments_data if isinstance(c.get('likes'), int)]
-                    if not comments_with_likes:
-                        st.info("Не знайдено коментарів з інформацією про лайки для відображення топу.")
-                    else:
-                        top_10_comments = sorted(comments_with_likes, key=lambda x: x['likes'], reverse=True)[:10]
-                        for i, comment_detail in enumerate(top_10_comments):
-                            st.markdown(f"---\n**{i + 1}.** 👍 {comment_detail['likes']:,} лайків")
-                            st.markdown(f"> {comment_detail['text']}")
-                            
-                            # Аналіз популярності окремого коментаря
-                            replies_texts = [r.get("snippet", {}).get("textDisplay", "") for r in comment_detail.get("replies", []) if r.get("snippet", {}).get("textDisplay")]
-                            with st.spinner(f"GPT аналізує популярність коментаря #{i+1}..."):
-                                popularity_analysis = gpt_analyze_comment_popularity(comment_detail['text'], replies_texts)
-                            st.markdown(f"<small style='color:grey;'><i><b>Аналіз популярності від GPT:</b> {popularity_analysis}</i></small>", unsafe_allow_html=True)
-
-                            # Відображення відповідей (якщо є)
-                            replies_list = comment_detail.get("replies", [])
-                            if replies_list:
-                                valid_replies = [
-                                    r for r in replies_list if isinstance(r, dict) and 
-                                    isinstance(r.get("snippet", {}).get("likeCount"), int) and
-                                    r.get("snippet", {}).get("textDisplay")]
-                                sorted_replies = sorted(valid_replies, key=lambda r_item: r_item["snippet"]["likeCount"], reverse=True)[:3]
-                                if sorted_replies:
-                                    with st.expander(f"💬 Показати до {len(sorted_replies)} найпопулярніших відповідей"):
-                                        for reply_item in sorted_replies:
-                                            reply_snippet = reply_item.get("snippet", {})
-                                            st.markdown(f"&nbsp;&nbsp;↳ {reply_snippet.get('textDisplay', '')} _(👍 {reply_snippet.get('likeCount', 0):,})_")
+                # 4. Топ-10 коментарів з аналізом популярності
+                st.markdown("##### 🔥 Топ-10 найпопулярніших коментарів (за лайками) та аналіз їх популярності:")
+                top_10_comments = comments_analysis["top_comments"]
+                if not top_10_comments:
+                    st.info("Не знайдено коментарів з інформацією про лайки для відображення топу.")
+                else:
+                    # Аналіз популярності всіх коментарів топу — один запит до GPT, запущений паралельно зі звітом
+                    with st.spinner("GPT аналізує популярність коментарів..."):
+                        popularity_analyses = comments_analysis["popularity"].result()
+
+                    for comment_detail in top_10_comments:
+                        st.markdown(f"---\n**{comment_detail['idx']}.** 👍 {fmt_int(comment_detail['likes'])} лайків")
+                        st.markdown(f"> {comment_detail['text']}")
+                        st.markdown(f"<small style='color:grey;'><i><b>Аналіз популярності від GPT:</b> {popularity_analyses[comment_detail['idx']]}</i></small>", unsafe_allow_html=True)
+
+                        # Відображення відповідей (якщо є)
+                        sorted_replies = comment_detail["top_replies"]
+                        if sorted_replies:
+                            with st.expander(f"💬 Показати до {len(sorted_replies)} найпопулярніших відповідей"):
+                                for reply_likes, reply_text in sorted_replies:
+                                    st.markdown(f"&nbsp;&nbsp;↳ {reply_text} _(👍 {fmt_int(reply_likes)})_")
+        analysis_status.update(label="Аналіз завершено", state="complete")